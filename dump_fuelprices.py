@@ -2,9 +2,37 @@ import logging
 import os
 import aiohttp
 import asyncio
-import aiofiles
+import functools
+import hashlib
 import json
-from datetime import datetime
+import re
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+
+    def json_dumps(data):
+        # Match the stdlib's handling of non-string keys such as integer site codes
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps(data):
+        return json.dumps(data, separators=(",", ":")).encode()
+
+    json_loads = json.loads
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Logging configuration
 logging.basicConfig(
@@ -23,189 +51,386 @@ BASE_URLS = {
     "get_fuel_prices": "https://ibjdnxs3i2.execute-api.ap-southeast-2.amazonaws.com/motrPrd/getSiteFuelPrices/{}",
 }
 
+# The fuel prices URL ends in its only placeholder, so per-site URLs are built from this prefix
+FUEL_PRICES_URL_PREFIX = BASE_URLS["get_fuel_prices"].removesuffix("{}")
+
+# Without Brotli, only ask for encodings aiohttp can decode by itself
+AUTO_DECOMPRESS = brotli is None
+
 HEADERS = {
     "AuthToken": AUTH_TOKEN_PROD,
-    "Accept-Encoding": "br",
+    "Accept-Encoding": "gzip, deflate" if AUTO_DECOMPRESS else "br",
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
 }
 
+# Maximum number of simultaneous connections to the API
+MAX_CONCURRENT_REQUESTS = 64
+
+# Response bodies larger than this are decompressed and parsed off the event loop
+OFFLOAD_THRESHOLD = 8192
+
 # Directories
 FUELPRICES_DIR = "fuelprices"
 PARSED_FUELPRICES_DIR = "docs/fuelprices_json"
 WEBPAGE_ROOT = "docs"
+HTTP_CACHE_DIR = ".http_cache"
+
+# Raw API responses are only archived when KEEP_RAW is set, since the
+# parsed files under docs/ are all the frontend needs
+KEEP_RAW = bool(os.getenv("KEEP_RAW"))
+
+def raw_shard(site_code):
+    """
+    Return the subdirectory of FUELPRICES_DIR that holds a site's raw response.
+    The raw archive is spread over 256 shards so no single directory grows unbounded.
+    """
+    return hashlib.blake2s(str(site_code).encode(), digest_size=1).hexdigest()
 
 # Ensure directories exist
-os.makedirs(FUELPRICES_DIR, exist_ok=True)
+if KEEP_RAW:
+    for shard in range(256):
+        os.makedirs(os.path.join(FUELPRICES_DIR, f"{shard:02x}"), exist_ok=True)
 os.makedirs(PARSED_FUELPRICES_DIR, exist_ok=True)
-logging.debug(f"AuthToken in headers: {HEADERS.get('AuthToken')}")
+os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+logging.debug("AuthToken in headers: %s", HEADERS.get("AuthToken"))
+
+# Dedicated threads for file I/O only. DNS lookups and CPU-bound response
+# decoding (decode_json) still use asyncio's default executor
+IO_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="fuelprices-io")
+
+async def run_io(func, *args):
+    """
+    Run a blocking file operation on the I/O thread pool.
+    """
+    return await asyncio.get_running_loop().run_in_executor(IO_POOL, func, *args)
+
+def _blocking_write(path, payload):
+    """
+    Write a payload to disk in a single open/write/close on a worker thread.
+    """
+    with open(path, "wb") as f:
+        f.write(payload)
+
+def _blocking_read(path):
+    """
+    Read a whole file from disk in a single open/read/close on a worker thread.
+    """
+    with open(path, "rb") as f:
+        return f.read()
+
+def _load_json(path):
+    """
+    Read and parse a JSON file in one call on a worker thread.
+    """
+    return json_loads(_blocking_read(path))
+
+def _flush_all(items):
+    """
+    Write every (path, payload) pair sequentially on a single worker thread.
+    """
+    for path, payload in items:
+        _blocking_write(path, payload)
+
+def _read_cache_entry(etag_path, body_path):
+    """
+    Return the cached (etag, body) pair, or (None, None) if either is missing.
+    """
+    try:
+        return _blocking_read(etag_path).decode(), _blocking_read(body_path)
+    except FileNotFoundError:
+        return None, None
+
+def _write_cache_entry(etag_path, body_path, etag, body):
+    """
+    Persist a response body and its ETag for the next run.
+    """
+    _blocking_write(body_path, body)
+    _blocking_write(etag_path, etag.encode())
 
 async def save_site_mappings(site_mappings):
     """
     Save site mappings to a JSON file.
     """
     mappings_filepath = os.path.join(WEBPAGE_ROOT, "site_mappings.json")
-    async with aiofiles.open(mappings_filepath, "w") as f:
-        await f.write(json.dumps(site_mappings, indent=4))
+    payload = json_dumps(site_mappings)
+    await run_io(_blocking_write, mappings_filepath, payload)
     print(f"Saved site mappings to {mappings_filepath}")
 
+_MS_DATE_RE = re.compile(r"\((\d+)")
+
+def _format_timestamp(ms_int):
+    """
+    Format a UTC millisecond timestamp as ISO 8601 without building a datetime.
+    """
+    t = time.gmtime(ms_int / 1000)
+    return "%04d-%02d-%02dT%02d:%02d:%02d" % (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
+
+@functools.lru_cache(maxsize=65536)
 def convert_date(ms_date):
     """
     Convert Microsoft JSON date format to ISO 8601.
+    Example: "/Date(1733180280000+1030)/"
     """
-    try:
-        timestamp = int(ms_date.split("(")[1].split("+")[0]) / 1000
-        return datetime.utcfromtimestamp(timestamp).isoformat()
-    except Exception as e:
-        print(f"Error converting date {ms_date}: {e}")
+    match = _MS_DATE_RE.search(ms_date) if ms_date else None
+    if not match:
+        print(f"Error converting date {ms_date}: no timestamp found")
         return None
+    return _format_timestamp(int(match.group(1)))
+
+
+def _decode_json(body, content_encoding):
+    """
+    Decompress a response body according to its Content-Encoding and parse it.
+    Returns the decompressed bytes alongside the parsed data.
+    """
+    if content_encoding == "br":
+        body = brotli.decompress(body)
+    elif content_encoding in ("gzip", "deflate"):
+        try:
+            body = zlib.decompress(body, zlib.MAX_WBITS | 32)
+        except zlib.error:
+            # Some servers send raw deflate streams without a zlib header
+            body = zlib.decompress(body, -zlib.MAX_WBITS)
+    return body, json_loads(body)
+
+async def decode_json(body, content_encoding=None):
+    """
+    Decode a body with _decode_json, on a worker thread if the body is large.
+    """
+    if len(body) > OFFLOAD_THRESHOLD:
+        return await asyncio.to_thread(_decode_json, body, content_encoding)
+    return _decode_json(body, content_encoding)
+
+async def read_json(response):
+    """
+    Read a response and decode it.
+    """
+    body = await response.read()
+    # aiohttp has already decoded the body when it decompresses itself
+    content_encoding = None if AUTO_DECOMPRESS else response.headers.get("Content-Encoding")
+    logging.debug("Response from %s: %d bytes", response.url, len(body))
+    return await decode_json(body, content_encoding)
 
 
 async def fetch_json(session, url):
     """
     Fetch JSON data from the given URL.
     """
-    async with session.get(url, headers=HEADERS) as response:
+    async with session.get(url) as response:
         response.raise_for_status()
-        return await response.json()
+        _, data = await read_json(response)
+    return data
 
 
-async def fetch_site_mappings():
+async def fetch_json_cached(session, url, cache_dir=HTTP_CACHE_DIR):
+    """
+    Fetch JSON data from the given URL, revalidating a cached copy with its ETag.
+    """
+    key = hashlib.sha1(url.encode()).hexdigest()
+    etag_path = os.path.join(cache_dir, f"{key}.etag")
+    body_path = os.path.join(cache_dir, f"{key}.body")
+
+    etag, cached_body = await run_io(_read_cache_entry, etag_path, body_path)
+    headers = None if etag is None else {"If-None-Match": etag}
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            logging.info("%s not modified, using cached response", url)
+            _, data = await decode_json(cached_body)
+            return data
+        response.raise_for_status()
+        body, data = await read_json(response)
+        new_etag = response.headers.get("ETag")
+
+    if new_etag:
+        await run_io(_write_cache_entry, etag_path, body_path, new_etag, body)
+    return data
+
+
+async def fetch_site_mappings(session):
     """
     Fetch site mappings from `get_sites` and `site`.
     """
-    async with aiohttp.ClientSession() as session:
-        # Fetch responses
-        get_sites_response = await fetch_json(session, BASE_URLS["get_sites"])
-        site_response = await fetch_json(session, BASE_URLS["get_site"])
-
-        # Validate `get_sites` response structure
-        if not isinstance(get_sites_response, dict) or "sites" not in get_sites_response:
-            logging.error(f"Unexpected structure in get_sites response: {type(get_sites_response)}")
-            return set(), {}
-
-        # Validate `site` response structure
-        if not isinstance(site_response, list):
-            logging.error(f"Unexpected structure in site response: {type(site_response)}")
-            return set(), {}
-
-        site_mappings = {}
-        site_codes_set = set()
-
-        # Process `get_sites` response
-        for site in get_sites_response["sites"]:
-            site_code = site.get("site_code")
-            if site_code:
-                site_mappings[site_code] = {
-                    "name": site.get("name", f"Site {site_code}"),
-                    "latitude": site.get("latitude"),
-                    "longitude": site.get("longitude"),
-                    "address": site.get("address"),
-                }
-                site_codes_set.add(site_code)
-
-        # Process `site` response
-        for site in site_response:
-            site_code = site.get("SiteCode")
-            if site_code:
-                if site_code not in site_mappings:
-                    site_mappings[site_code] = {}
-                site_mappings[site_code].update({
-                    "name": site.get("SiteName", f"Site {site_code}"),
-                    "latitude": site.get("Latitude"),
-                    "longitude": site.get("Longitude"),
-                    "address": site.get("StreetAddress"),
-                })
-                site_codes_set.add(site_code)
-
-        logging.info(f"Generated site mappings for {len(site_mappings)} sites.")
-        return site_codes_set, site_mappings
-
-async def fetch_and_save_fuel_prices(site_codes, site_mappings):
+    # Fetch both responses in parallel; they do not depend on each other
+    get_sites_response, site_response = await asyncio.gather(
+        fetch_json_cached(session, BASE_URLS["get_sites"]),
+        fetch_json_cached(session, BASE_URLS["get_site"]),
+    )
+
+    # Validate `get_sites` response structure
+    if not isinstance(get_sites_response, dict) or "sites" not in get_sites_response:
+        logging.error("Unexpected structure in get_sites response: %s", type(get_sites_response))
+        return frozenset(), {}
+
+    # Validate `site` response structure
+    if not isinstance(site_response, list):
+        logging.error("Unexpected structure in site response: %s", type(site_response))
+        return frozenset(), {}
+
+    site_mappings = {}
+    site_codes_set = set()
+
+    # Process `get_sites` response
+    for site in get_sites_response["sites"]:
+        site_code = site.get("site_code")
+        if site_code:
+            site_mappings[site_code] = {
+                "name": site.get("name", f"Site {site_code}"),
+                "latitude": site.get("latitude"),
+                "longitude": site.get("longitude"),
+                "address": site.get("address"),
+            }
+            site_codes_set.add(site_code)
+
+    # Process `site` response
+    for site in site_response:
+        site_code = site.get("SiteCode")
+        if site_code:
+            if site_code not in site_mappings:
+                site_mappings[site_code] = {}
+            site_mappings[site_code].update({
+                "name": site.get("SiteName", f"Site {site_code}"),
+                "latitude": site.get("Latitude"),
+                "longitude": site.get("Longitude"),
+                "address": site.get("StreetAddress"),
+            })
+            site_codes_set.add(site_code)
+
+    logging.info("Generated site mappings for %d sites.", len(site_mappings))
+    return frozenset(site_codes_set), site_mappings
+
+async def save_fuel_prices(site_code, result, site_mappings):
+    """
+    Merge a site's fetched fuel prices into its parsed file and save it.
+    """
+    writes = []
+
+    # Save raw API response
+    if KEEP_RAW:
+        raw_filepath = f"{FUELPRICES_DIR}/{raw_shard(site_code)}/fuelprices_{site_code}.json"
+        writes.append((raw_filepath, json_dumps(result)))
+
+    # Prepare new prices array
+    new_prices = []
+    for entry in result.get("sitefuelprices", []):
+        department_code = entry.get("department_code")
+        price = entry.get("current_price")
+        date = convert_date(entry["date_entered"])
+        if department_code and price and date:
+            new_prices.append({
+                "department_code": department_code,
+                "date": date,
+                "price": price,
+            })
+
+    # Load existing data if available
+    parsed_filepath = f"{PARSED_FUELPRICES_DIR}/fuelprices_{site_code}.json"
+    try:
+        existing_data = await run_io(_load_json, parsed_filepath)
+        existing_prices = existing_data.get("prices", [])
+        changed = False
+    except FileNotFoundError:
+        # Site mapping details are only needed to start a new file
+        site_details = site_mappings.get(site_code) or {}
+        existing_data = {
+            "site_code": site_code,
+            "site_name": site_details.get("name", f"Site {site_code}"),
+            "latitude": site_details.get("latitude"),
+            "longitude": site_details.get("longitude"),
+            "prices": [],
+        }
+        existing_prices = []
+        # A site seen for the first time always gets a file for the frontend
+        changed = True
+
+    # Append only prices whose (date, department_code) is not already stored
+    existing_keys = {(p["date"], p["department_code"]) for p in existing_prices}
+    for price in new_prices:
+        key = (price["date"], price["department_code"])
+        if key not in existing_keys:
+            existing_prices.append(price)
+            existing_keys.add(key)
+            changed = True
+
+    if changed:
+        # Queue updated parsed data to be written back to the file
+        existing_data["prices"] = existing_prices
+        writes.append((parsed_filepath, json_dumps(existing_data)))
+    else:
+        logging.debug("No new prices for site_code %s, skipping %s", site_code, parsed_filepath)
+
+    # Write the site's files in one worker-thread call
+    if writes:
+        await run_io(_flush_all, writes)
+        logging.info("Saved fuel prices for site_code %s", site_code)
+
+async def _fetch_and_write(session, semaphore, site_code, site_mappings):
+    """
+    Fetch and save fuel prices for one site, logging failures instead of raising them.
+    """
+    url = f"{FUEL_PRICES_URL_PREFIX}{site_code}"
+    try:
+        # Hold the slot until the site is written, so at most
+        # MAX_CONCURRENT_REQUESTS responses are resident at once
+        async with semaphore:
+            result = await fetch_json(session, url)
+            await save_fuel_prices(site_code, result, site_mappings)
+    except Exception as e:
+        logging.error("Failed to update fuel prices for site_code %s: %s", site_code, e)
+
+async def fetch_and_save_fuel_prices(session, site_codes, site_mappings):
     """
     Fetch and save fuel prices for each site code.
+    `site_codes` may be any iterable; duplicates are fetched only once.
     """
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for site_code in site_codes:
-            url = BASE_URLS["get_fuel_prices"].format(site_code)
-            tasks.append(fetch_json(session, url))
-
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-
-        for site_code, result in zip(site_codes, results):
-            if isinstance(result, Exception):
-                logging.error(f"Failed to fetch data for site_code {site_code}: {result}")
-                continue
-
-            # Save raw API response
-            raw_filename = f"fuelprices_{site_code}.json"
-            raw_filepath = os.path.join(FUELPRICES_DIR, raw_filename)
-            async with aiofiles.open(raw_filepath, "w") as f:
-                await f.write(json.dumps(result, indent=4))
-            logging.info(f"Raw API response for site_code {site_code} saved to {raw_filepath}")
-
-            # Initialize site mapping details
-            site_details = site_mappings.get(site_code, {"name": f"Site {site_code}"})
-            site_name = site_details.get("name")
-            latitude = site_details.get("latitude")
-            longitude = site_details.get("longitude")
-
-            # Prepare new prices array
-            new_prices = []
-            for entry in result.get("sitefuelprices", []):
-                department_code = entry.get("department_code")
-                price = entry.get("current_price")
-                date = convert_date(entry["date_entered"])
-                if department_code and price and date:
-                    new_prices.append({
-                        "department_code": department_code,
-                        "date": date,
-                        "price": price,
-                    })
-
-            # Load existing data if available
-            parsed_filename = f"fuelprices_{site_code}.json"
-            parsed_filepath = os.path.join(PARSED_FUELPRICES_DIR, parsed_filename)
-            try:
-                async with aiofiles.open(parsed_filepath, "r") as f:
-                    existing_data = json.loads(await f.read())
-                    existing_prices = existing_data.get("prices", [])
-            except FileNotFoundError:
-                existing_data = {
-                    "site_code": site_code,
-                    "site_name": site_name,
-                    "latitude": latitude,
-                    "longitude": longitude,
-                    "prices": [],
-                }
-                existing_prices = []
-
-            # Merge new prices with existing prices (avoid duplicates)
-            updated_prices = {f"{p['date']}_{p['department_code']}": p for p in existing_prices + new_prices}
-            existing_data["prices"] = list(updated_prices.values())
-
-            # Save updated parsed data back to the file
-            async with aiofiles.open(parsed_filepath, "w") as f:
-                await f.write(json.dumps(existing_data, indent=4))
-            logging.info(f"Parsed fuel prices for site_code {site_code} saved to {parsed_filepath}")
+    # Keep in-flight sites at the connector's limit so queued requests
+    # do not spend their timeout waiting for a free connection
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    # Each site is fetched, merged and written by its own task
+    async with asyncio.TaskGroup() as tg:
+        for site_code in frozenset(site_codes):
+            tg.create_task(_fetch_and_write(session, semaphore, site_code, site_mappings))
 
 async def main():
     """
     Main function to orchestrate the workflow.
     """
-    # Fetch site codes and mappings
-    site_codes_set, site_mappings = await fetch_site_mappings()
-
-    if not site_codes_set:
-        logging.error("No site codes were retrieved. Exiting.")
-        return
-
-    # Save site mappings for the frontend
-    await save_site_mappings(site_mappings)
-
-    # Fetch and save fuel prices
-    await fetch_and_save_fuel_prices(site_codes_set, site_mappings)
+    # The connector bounds in-flight requests and caches the API host's DNS
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENT_REQUESTS,
+        limit_per_host=MAX_CONCURRENT_REQUESTS,
+        ttl_dns_cache=600,
+        # Outlive a typical API Gateway idle period between request bursts
+        keepalive_timeout=75,
+        enable_cleanup_closed=True,
+    )
+    timeout = aiohttp.ClientTimeout(total=30, connect=5)
+    # Share one session (and its keep-alive pool) across every request
+    # With Brotli available, bodies are decompressed by read_json so large ones
+    # can leave the event loop
+    async with aiohttp.ClientSession(
+        headers=HEADERS,
+        connector=connector,
+        timeout=timeout,
+        auto_decompress=AUTO_DECOMPRESS,
+    ) as session:
+        # Fetch site codes and mappings
+        site_codes_set, site_mappings = await fetch_site_mappings(session)
+
+        if not site_codes_set:
+            logging.error("No site codes were retrieved. Exiting.")
+            return
+
+        # Save site mappings for the frontend
+        await save_site_mappings(site_mappings)
+
+        # Fetch and save fuel prices
+        await fetch_and_save_fuel_prices(session, site_codes_set, site_mappings)
 
 # Run the script
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -1,11 +1,34 @@
+import functools
 import os
-import json
+import re
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
 DATA_DIR = "fuelprices"
 GRAPH_DIR = "graphs"
 
+# Raw responses are saved by dump_fuelprices.py as fuelprices_<site_code>.json
+DATA_FILE_PREFIX = "fuelprices_"
+DATA_FILE_SUFFIX = ".json"
+
+# Number of threads used to read fuel price files
+LOAD_WORKERS = 16
+
 DEPARTMENT_CODE_MAPPING = {
     "Premium Unleaded": 1,
     "Unleaded": 2,
@@ -18,79 +41,153 @@ DEPARTMENT_CODE_MAPPING = {
     "Low Aromatic": 11
 }
 
+# simdjson parsers reuse their buffers and cannot be shared between threads
+_thread_state = threading.local()
+
+def _parse_sitefuelprices(raw):
+    """
+    Parse a fuel price file and return only its sitefuelprices value.
+    """
+    if simdjson is None:
+        return json_loads(raw).get("sitefuelprices", [])
+    parser = getattr(_thread_state, "parser", None)
+    if parser is None:
+        parser = _thread_state.parser = simdjson.Parser()
+    sitefuelprices = parser.parse(raw).get("sitefuelprices", [])
+    # Materialise the array before the parser is reused for the next file
+    if isinstance(sitefuelprices, simdjson.Array):
+        return sitefuelprices.as_list()
+    return sitefuelprices
+
+def _load_sitefuelprices(dir_entry):
+    """
+    Read one fuel price file and return its site code and a list of
+    (department_code, date, price) points.
+    """
+    file = dir_entry.name
+    site_code = _site_code_from_filename(file)
+    with open(dir_entry.path, "rb") as f:
+        try:
+            # Extract sitefuelprices and ensure it's a list
+            sitefuelprices = _parse_sitefuelprices(f.read())
+            if not isinstance(sitefuelprices, list):
+                print(f"Unexpected structure for sitefuelprices in {file}")
+                return site_code, []
+            points = []
+            for entry in sitefuelprices:
+                ms_date = entry.get("date_entered")
+                price = entry.get("current_price")
+                if ms_date is None or price is None:
+                    # Keep a None date so only this department's graph is skipped
+                    print(f"Missing date or price for department {entry.get('department_code')} in {file}")
+                    points.append((entry.get("department_code"), None, price))
+                    continue
+                points.append((entry.get("department_code"), convert_date(ms_date), price))
+            return site_code, points
+        except ValueError as e:
+            print(f"Error decoding JSON in {file}: {e}")
+        except Exception as e:
+            print(f"Error loading fuel prices from {file}: {e}")
+    return site_code, []
+
+def _site_code_from_filename(name):
+    """
+    Return the site code from a "fuelprices_<site_code>.json" filename, or None.
+    """
+    if name.startswith(DATA_FILE_PREFIX) and name.endswith(DATA_FILE_SUFFIX):
+        return name[len(DATA_FILE_PREFIX):-len(DATA_FILE_SUFFIX)]
+    return None
+
+def _iter_data_files():
+    """
+    Yield fuel price files in DATA_DIR's hash-shard subdirectories, then any
+    files left in DATA_DIR itself for sites that have no sharded copy yet.
+    """
+    shards = []
+    flat_files = []
+    with os.scandir(DATA_DIR) as it:
+        for dir_entry in it:
+            if dir_entry.is_dir():
+                shards.append(dir_entry.path)
+            elif _site_code_from_filename(dir_entry.name):
+                flat_files.append(dir_entry)
+
+    sharded_sites = set()
+    for shard in shards:
+        with os.scandir(shard) as it:
+            for dir_entry in it:
+                site_code = _site_code_from_filename(dir_entry.name)
+                if site_code:
+                    sharded_sites.add(site_code)
+                    yield dir_entry
+    for dir_entry in flat_files:
+        if _site_code_from_filename(dir_entry.name) not in sharded_sites:
+            yield dir_entry
+
 def load_fuel_prices():
     """
-    Load fuel prices from JSON files into a dictionary.
+    Load fuel prices from JSON files into a dictionary indexed by
+    (site_code, department_code), holding (date, price) pairs.
     """
-    fuel_data = {}
-    for file in os.listdir(DATA_DIR):
-        if file.endswith("_fuelprices.json"):
-            site_code = file.split("_")[0]
-            filepath = os.path.join(DATA_DIR, file)
-            with open(filepath, "r") as f:
-                try:
-                    data = json.load(f)
-                    # Extract sitefuelprices and ensure it's a list
-                    sitefuelprices = data.get("sitefuelprices", [])
-                    if isinstance(sitefuelprices, list):
-                        fuel_data[site_code] = sitefuelprices
-                    else:
-                        print(f"Unexpected structure for sitefuelprices in {file}")
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON in {file}: {e}")
+    fuel_data = defaultdict(list)
+    entries = list(_iter_data_files())
+
+    # Read and parse the files concurrently, then index them here
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+        for site_code, points in executor.map(_load_sitefuelprices, entries):
+            for department_code, date, price in points:
+                fuel_data[(site_code, department_code)].append((date, price))
     return fuel_data
 
 if not os.path.exists(GRAPH_DIR):
     os.makedirs(GRAPH_DIR)
 
+_MS_DATE_RE = re.compile(r"\((\d+)")
+
+# datetimes are immutable, so repeated timestamps can share one object
+@functools.lru_cache(maxsize=65536)
 def convert_date(ms_date):
     """
     Convert Microsoft JSON date format to Python datetime.
     Example: "/Date(1733180280000+1030)/"
     """
-    try:
-        timestamp = int(ms_date.split("(")[1].split("+")[0]) / 1000
-        return datetime.fromtimestamp(timestamp)
-    except Exception as e:
-        print(f"Error converting date {ms_date}: {e}")
+    match = _MS_DATE_RE.search(ms_date) if ms_date else None
+    if not match:
+        print(f"Error converting date {ms_date}: no timestamp found")
         return None
+    return datetime.fromtimestamp(int(match.group(1)) / 1000)
 
 def generate_graphs(fuel_data, date_range, department_code):
     """
     Generate graphs for fuel prices for the given department code and date range.
     """
-    for site_code, data in fuel_data.items():
+    # One figure is reused for every site to avoid rebuilding it each time
+    fig, ax = plt.subplots()
+    site_codes = dict.fromkeys(site_code for site_code, _ in fuel_data)
+    for site_code in site_codes:
         print(f"Generating graph for site_code {site_code}...")
         try:
-            prices = [
-                entry["current_price"]
-                for entry in data
-                if entry.get("department_code") == department_code
-            ]
-            dates = [
-                convert_date(entry["date_entered"])
-                for entry in data
-                if entry.get("department_code") == department_code
-            ]
-
-            # Filter out any None values in dates
-            if not prices or not dates or None in dates:
+            points = fuel_data.get((site_code, department_code))
+
+            # Skip sites without data or with any unparseable dates
+            if not points or any(date is None for date, _ in points):
                 print(f"No valid data for site_code {site_code} with department_code {department_code}")
                 continue
+            dates, prices = zip(*points)
 
-            plt.figure()
-            plt.plot(dates, prices)
-            plt.title(f"Fuel Prices for {site_code} ({department_code})")
-            plt.xlabel("Date")
-            plt.ylabel("Price")
-            plt.grid(True)
+            ax.clear()
+            ax.plot(dates, prices)
+            ax.set_title(f"Fuel Prices for {site_code} ({department_code})")
+            ax.set_xlabel("Date")
+            ax.set_ylabel("Price")
+            ax.grid(True)
 
             filename = os.path.join(GRAPH_DIR, f"{site_code}_{date_range}_{department_code}.jpg")
-            plt.savefig(filename)
-            plt.close()
+            fig.savefig(filename)
             print(f"Graph saved to {filename}")
         except Exception as e:
             print(f"Error generating graph for site_code {site_code}: {e}")
+    plt.close(fig)
 
 if __name__ == "__main__":
     fuel_data = load_fuel_prices()